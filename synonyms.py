@@ -12,60 +12,124 @@ print(f"More frequent then '{word}' synonyms are: {synonyms_m}")
 
 should produce an output similar to this one:
 
-[nltk_data] Downloading package wordnet to /home/edh/nltk_data...
-[nltk_data]   Package wordnet is already up-to-date!
 Most frequent synonyms for 'tryout' are: [('test', 1.0)]
-Complete list of synonyms is: ['test', 'trial']
+Complete list of synonyms is: ['audition', 'test', 'trial']
 More frequent then 'tryout' synonyms are: [('test', 824.62218), ('trial', 141.58117)]
 """
 import nltk
 from nltk.corpus import wordnet
-import requests
-import json
+import httpx
+# orjson decodes bytes directly and much faster, but stdlib json will do as well
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import dbm
+import importlib.util
+import os
+import shelve
+import time
+import urllib.parse
+from typing import Callable, Literal, MutableMapping
 import numpy as np
 
-# Ensure you have downloaded WordNet
-nltk.download('wordnet')
+# N-gram request parameters. They are the part of the cache key as well, thus changing them here will not
+# pick up the values stored for another corpus or timeline
+NGRAM_CORPUS = "ru"
+NGRAM_YEAR_START = 2000
+NGRAM_YEAR_END = 2019
+# corpus data may start at 1900
+# corpus en. en-US, en-GB, en-2012 (from 1970), fr
+_URL_FORMAT = ("https://books.google.com/ngrams/json?content={content}&year_start={year_start}"
+               "&year_end={year_end}&corpus={corpus}&smoothing=3&key={key}")
+# How many comma separated words are sent to N-gram API in one request
+NGRAM_BATCH_SIZE = 12
+# How many batches are requested in parallel when we have to use threads instead of asyncio
+NGRAM_WORKERS = 8
+# Frequencies are stored on disk between the runs, since the same words are requested again and again.
+# The file lives in the user's cache directory, not in the directory the caller was started from
+NGRAM_CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")),
+                                "synonyms", "ngram_cache.db")
+
+# up to 3 seconds for establishing connection and sending rrequest
+# up to 8 seconds if server is slow in generating result or/and connection is slow while the response size is lengthy
+_TIMEOUT = httpx.Timeout(8.0, connect=3.0)
+# Timed out requests and server errors are repeated up to NGRAM_ATTEMPTS times in total with a small growing pause
+# (0.3, 0.6, ... seconds), failed connection attempts are repeated by the transports below as well
+NGRAM_ATTEMPTS = 3
+_RETRY_BACKOFF = 0.3
+_RETRY_STATUSES = {500, 502, 503, 504}
+_LIMITS = httpx.Limits(max_keepalive_connections=8, max_connections=16)
+# HTTP/2 needs the optional h2 package (pip install httpx[http2]), otherwise we stay with HTTP/1.1
+_HTTP2 = importlib.util.find_spec("h2") is not None
+# One client for the whole module keeps the connection to books.google.com alive between requests,
+# and the transport repeats failed connection attempts for us instead of a hand-made loop
+_CLIENT = httpx.Client(timeout=_TIMEOUT, transport=httpx.HTTPTransport(http2=_HTTP2, limits=_LIMITS, retries=3))
+
+# WordNet is a closed vocabulary, so synonyms found once for a (normalized) word stay valid for the whole run.
+# Callers get copies of the cached lists
+_SYN_CACHE: dict[tuple[str, str, int|None], list[str]] = {}
+
+# Ensure you have downloaded WordNet. It is checked on the first WordNet access only, so importing this module
+# does not touch the network when only N-gram frequencies are needed
+_WN_READY = False
+
+def _ensure_wordnet():
+    global _WN_READY
+    if _WN_READY:
+        return
+    try:
+        wordnet.synsets("test")
+    except LookupError:
+        nltk.download('wordnet', quiet=True)
+    _WN_READY = True
+
 # Use nltk's WordNet to get synonyms of the given word
-### Input: string containing one word, 3 character length at least.
+### Input: string containing one word, 3 character length at least, and the scope of the synonyms:
+# "all" takes lemmas of every synset found, "first" uses the "main" i.e. the first synset only and truncates
+# "wider" synonyms (this is what wordnet.synonyms(word)[0] returns).
+# Optional top_k drops the synonyms never seen in WordNet's tagged texts (lemma count is zero) and keeps up to top_k
+# most tagged ones only. Be careful, lemma count is the number of times this particular sense was tagged in SemCor, a small
+# hand-tagged corpus, it is not a word frequency. Thus quite common synonyms may be dropped as well
 ### Output: list of strings representing one-word synonyms or empty list when no synonyms were found
-# or the word is unique, or probably mistyped
+# or the word is unique, or probably mistyped. With top_k the list is ordered by lemma count, most tagged first
 # Making the set/list of synonyms manually, we offer space for additional operations.
 # For example, calling wordnet.synsets('dog', pos=wordnet.VERB) will return word "chase"
-def get_synonyms_by_lemmas(word: str) -> list[str]:
+def get_synonyms(word: str, scope: Literal["first", "all"] = "all", top_k: int|None = None) -> list[str]:
     # Get all synsets (sets of synonymous words) for the given word
-    word = word.lower().lstrip().rstrip()
-    if len(word)>2:
-        synsets = wordnet.synsets(word)
-        synonyms = set()
+    word = word.strip().lower()
+    if len(word)<=2:
+        return []
+    if (word, scope, top_k) in _SYN_CACHE:
+        return list(_SYN_CACHE[word, scope, top_k])
+    _ensure_wordnet()
+    synsets = wordnet.synsets(word)
+    if scope == "first":
+        synsets = synsets[:1]
+    if top_k is None:
+        # Collect the lemmas (synonyms) of the synsets, we do not need composite synonyms.
+        # The set removes duplicates and we drop the initial word as well
+        synonyms = list({lemma.name().lower() for synset in synsets for lemma in synset.lemmas()
+                         if "_" not in lemma.name()} - {word})
+    else:
+        # The same synonym may appear in several synsets, thus its counts are summed up
+        counts: dict[str, int] = {}
         for synset in synsets:
             for lemma in synset.lemmas():
-                # Add the lemmas (synonyms) to the set
                 wrd = lemma.name().lower()
-                # We do not need composite synonyms
-                if "_" not in wrd:
-                    synonyms.add(wrd)
-        # Remove duplicates and initial word; and return as a list
-        return list(synonyms - {word})
-    else:
-        return []
-
-# These two functions are almost the same and wordnet.synonyms() will produce the same result, but we truncate
-# "wider" synonyms from our scope
-def get_synonyms(word: str) -> list[str]:
-    # Get all synsets (sets of synonymous words) for the given word
-    word = word.lower().lstrip().rstrip()
-    if len(word)>2:
-        # since the main function synonyms() returns list of the lists for possible candidates,
-        # we will use the "main" i.e. the unique elements from the first sublist only, removing composite words too
-        return [wrd for wrd in set(wordnet.synonyms(word)[0]) if "_" not in wrd]
-    else:
-        return []
+                if "_" not in wrd and wrd != word:
+                    counts[wrd] = counts.get(wrd, 0) + lemma.count()
+        synonyms = [wrd for wrd in sorted(counts, key=counts.get, reverse=True) if counts[wrd]>0][:top_k]
+    _SYN_CACHE[word, scope, top_k] = synonyms
+    return list(synonyms)
 
 # To get the synonyms arranged in accordance to their appearence frequences in real texts,
 # we are using Google's Book API. Thus a user should provide a valid API key.
-# Here we try to push a but and make several attempts when connection fails.
-# We do not look for a specific frequency and calculate it's mean value over all years reported by API
+# Here we try to push a but and make several attempts when connection fails (see _CLIENT).
+# We do not look for a specific frequency and take its peak value over the recent years reported by API
 ### Input: the word to be processed
 ### Output: a float/real number in terms of internal Google's metrics. Zero will be returned if no such word exists or
 # some connection/API failure appeared
@@ -73,42 +137,179 @@ def get_synonym_frequency(word : str,googleAPI_key : str ="") -> float:
     """
     Fetch synonym frequencies from Google N-Gram Viewer API.
     """
-    # corpus data may start at 1900
-    # corpus en. en-US, en-GB, en-2012 (from 1970), fr
-    url = f"https://books.google.com/ngrams/json?content={word}&year_start=1800&year_end=2024&corpus=ru&smoothing=3&key={googleAPI_key}"
-    
-    timeout_attempts = 3
-    while timeout_attempts>0:
-        try: # up to 3 seconds for establishing connection and sending rrequest
-             # up to 8 seconds if server is slow in generating result or/and connection is slow while the response size is lengthy
-            resp = requests.get(url, timeout=(3, 8))
-        except requests.exceptions.Timeout:
-            timeout_attempts -= 1
-        except requests.exceptions.RequestException as e:
-            print("Request failed:", e)
-            break
+    return get_synonym_frequencies([word], googleAPI_key)[word]
+
+# N-gram query specialized for a corpus and timeline. Everything but the words and the key is baked into the URL
+# template once, so the fetcher does not format the query constants per call. Cached values are kept apart for every corpus
+### Input: corpus name as N-gram API knows it and years range
+### Output: function taking a list of words and optional API key, and working as get_synonym_frequencies() does
+def _make_fetcher(corpus : str, year_start : int, year_end : int) -> Callable[[list[str], str], dict[str,float]]:
+    template = _URL_FORMAT.format(content="{content}", year_start=year_start, year_end=year_end,
+                                  corpus=corpus, key="{key}")
+    cache_suffix = f"{corpus}|{year_start}-{year_end}"
+    def fetch(words : list[str], googleAPI_key : str ="") -> dict[str,float]:
+        return _get_frequencies(words, googleAPI_key, template, cache_suffix)
+    return fetch
+
+# The same as get_synonym_frequency(), but for a bunch of words at once. N-gram API accepts several comma separated
+# phrases in one request, so the words are sent in batches of NGRAM_BATCH_SIZE and those batches are requested concurrently.
+# Words already known from the on-disk cache are not requested at all
+### Input: list of words and optional API key
+### Output: dictionary word -> frequency. Zero is reported for non-existing words and when connection/API failure appeared
+get_synonym_frequencies = _make_fetcher(NGRAM_CORPUS, NGRAM_YEAR_START, NGRAM_YEAR_END)
+
+def _get_frequencies(words : list[str], googleAPI_key : str, template : str, cache_suffix : str) -> dict[str,float]:
+    cache = _get_ngram_cache()
+    missing = [w for w in dict.fromkeys(words) if _cache_key(w, cache_suffix) not in cache]
+    if len(missing)>0:
+        batches = [missing[i:i+NGRAM_BATCH_SIZE] for i in range(0, len(missing), NGRAM_BATCH_SIZE)]
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = False
         else:
-            # We got response, leaving aux loop
-            break
-    if resp.ok:
+            running_loop = True
+        if len(batches)==1:
+            # nothing to run in parallel, the long-lived client reuses its keep-alive connection
+            fetched = [_request_frequencies(batches[0], googleAPI_key, template)]
+        elif not running_loop:
+            fetched = asyncio.run(_fetch_all(batches, googleAPI_key, template))
+        else:
+            # asyncio.run() can not be nested into a running event loop (Jupyter for example), so we fall back to threads
+            # sharing the synchronous client. They wait for the network, not for the GIL, thus the batches still go in parallel
+            with ThreadPoolExecutor(max_workers=NGRAM_WORKERS) as ex:
+                fetched = list(ex.map(lambda batch: _request_frequencies(batch, googleAPI_key, template), batches))
+        for batch, frequencies in zip(batches, fetched):
+            if frequencies is not None:
+                for w in batch:
+                    if w in frequencies or _is_plain_word(w):
+                        cache[_cache_key(w, cache_suffix)] = frequencies.get(w, 0.0)
+    return {w: cache.get(_cache_key(w, cache_suffix), 0.0) for w in words}
+
+# The shelf is opened on first use only and closed when the interpreter exits.
+# When it can not be opened (read-only home, or the file is locked by another process using this module)
+# we keep the values in memory for this run only
+_ngram_cache = None
+
+def _get_ngram_cache() -> MutableMapping:
+    global _ngram_cache
+    if _ngram_cache is None:
         try:
-            data = json.loads(resp.content)
-        except:  # includes simplejson.decoder.JSONDecodeError
-            print('Decoding JSON has failed')
-            return 0.0
+            os.makedirs(os.path.dirname(NGRAM_CACHE_FILE), exist_ok=True)
+            _ngram_cache = shelve.open(NGRAM_CACHE_FILE)
+        except (OSError, *dbm.error) as e:
+            print("N-gram cache is not available, using memory only:", e)
+            _ngram_cache = {}
         else:
-        # Extract the frequency from the first result if it exists or zero otherwise
-            frequency = 0.0
-            if len(data)>0:
-                res = np.array(data[0]['timeseries'])
-                # We have to cautious here, since we are requesting a wide timeline data, thus for newer words this
-                # sequence may contain zeros and standard average will compute a logically invalid value.
-                # Thus we have to do it manually
-                frequency =np.true_divide(res.sum(0), (res != 0).sum(0))
-        return frequency
-    else:
-        print(f"Failed to fetch frequency for '{word}'")
-        return 0.0
+            atexit.register(_ngram_cache.close)
+    return _ngram_cache
+
+# API simply omits the words it has no data for, so a plain word missing from the answer is a known zero and is cached.
+# Words with hyphens, spaces or punctuation may be reported under a different spelling, so their zero is not persisted
+def _is_plain_word(word : str) -> bool:
+    return word.isalpha()
+
+def _cache_key(word : str, cache_suffix : str) -> str:
+    return f"{word}|{cache_suffix}"
+
+# Every word is quoted, so the words containing '&' or spaces do not break the query
+def _ngram_url(words : list[str], googleAPI_key : str, template : str) -> str:
+    content = ",".join(urllib.parse.quote(w, safe="") for w in words)
+    return template.format(content=content, key=urllib.parse.quote(googleAPI_key, safe=""))
+
+# API returns one entry per found phrase, the words w/o any data are simply missing in the answer
+def _parse_frequencies(data) -> dict[str,float]:
+    return {entry['ngram']: _timeseries_frequency(entry['timeseries']) for entry in data}
+
+def _timeseries_frequency(timeseries) -> float:
+    arr = np.asarray(timeseries)
+    # The timeline is short and recent, so the maximum is a good estimate of the modern usage and,
+    # unlike the average, it is not spoiled by the zero years of the newer words
+    return float(arr.max()) if arr.size else 0.0
+
+# Check and decode N-gram API answer, the same for synchronous and asynchronous requests
+### Input: the response received and the batch of words it was requested for
+### Output: the same as _parse_frequencies() produces, but None on API failure
+def _handle_response(resp : httpx.Response, words : list[str]) -> dict[str,float]|None:
+    if not resp.is_success:
+        print(f"Failed to fetch frequency for {words}")
+        return None
+    try:
+        data = loads(resp.content)
+    except ValueError:  # both json and orjson JSONDecodeError are derived from it
+        print('Decoding JSON has failed')
+        return None
+    return _parse_frequencies(data)
+
+# Synchronous request of one batch of words
+### Input: the batch of words to be processed
+### Output: the same as _parse_frequencies() produces, but None on connection/API failure
+def _request_frequencies(words : list[str], googleAPI_key : str, template : str) -> dict[str,float]|None:
+    url = _ngram_url(words, googleAPI_key, template)
+    resp = None
+    for attempt in range(NGRAM_ATTEMPTS):
+        if attempt>0:
+            time.sleep(_RETRY_BACKOFF * 2**(attempt-1))
+        try:
+            resp = _CLIENT.get(url)
+        except httpx.TimeoutException:
+            resp = None
+            continue
+        except httpx.HTTPError as e:
+            print("Request failed:", e)
+            return None
+        if resp.status_code not in _RETRY_STATUSES:
+            break
+    if resp is None:
+        print(f"Request timed out {NGRAM_ATTEMPTS} times for {words}")
+        return None
+    return _handle_response(resp, words)
+
+# The N-gram requests are network bound, so instead of waiting for every batch one by one we fire them all at once
+# and wait for the whole bunch. With HTTP/2 they are multiplexed over a single connection. Timeouts follow the synchronous version
+### Input: an open asynchronous client and the batch of words to be processed
+### Output: the same as _parse_frequencies() produces, but None on connection/API failure
+async def _fetch_frequencies(client : httpx.AsyncClient, words : list[str], googleAPI_key : str,
+                             template : str) -> dict[str,float]|None:
+    url = _ngram_url(words, googleAPI_key, template)
+    resp = None
+    for attempt in range(NGRAM_ATTEMPTS):
+        if attempt>0:
+            await asyncio.sleep(_RETRY_BACKOFF * 2**(attempt-1))
+        try:
+            resp = await client.get(url)
+        except httpx.TimeoutException:
+            resp = None
+            continue
+        except httpx.HTTPError as e:
+            print("Request failed:", e)
+            return None
+        if resp.status_code not in _RETRY_STATUSES:
+            break
+    if resp is None:
+        print(f"Request timed out {NGRAM_ATTEMPTS} times for {words}")
+        return None
+    return _handle_response(resp, words)
+
+### Input: list of batches of words
+### Output: list of _fetch_frequencies() results in the same order as the batches were given
+async def _fetch_all(batches : list[list[str]], googleAPI_key : str, template : str) -> list[dict[str,float]|None]:
+    # asynchronous client is bound to the event loop, thus it can not be shared between asyncio.run() calls
+    transport = httpx.AsyncHTTPTransport(http2=_HTTP2, limits=_LIMITS, retries=3)
+    async with httpx.AsyncClient(timeout=_TIMEOUT, transport=transport) as client:
+        return await asyncio.gather(*[_fetch_frequencies(client, batch, googleAPI_key, template) for batch in batches])
+
+# Frequencies in the English books corpus, for the words which are not expected to appear in the Russian one
+get_synonym_frequencies_en = _make_fetcher("en-2019", NGRAM_YEAR_START, NGRAM_YEAR_END)
+
+# Sort words from the most frequent towards the least frequent one. Stable sorting keeps the original order for equal values
+### Input: dictionary word -> frequency
+### Output: two numpy arrays, words and their frequencies, in descending order of frequency
+def _rank_frequencies(frequency_dict : dict[str,float]) -> tuple[np.ndarray, np.ndarray]:
+    words = np.array(list(frequency_dict.keys()))
+    freqs = np.fromiter(frequency_dict.values(), dtype=np.float64, count=len(frequency_dict))
+    order = np.argsort(-freqs, kind="stable")
+    return words[order], freqs[order]
 
 # Getting a <dumb> list of synonyms is not sufficient in most cases. Normally we want to get a list
 # where synonyms will be ordered from most frequent towards the least frequent.
@@ -118,6 +319,8 @@ def get_synonym_frequency(word : str,googleAPI_key : str ="") -> float:
 # The value like 0.25 means that we want to exclude all synonyms which are more then 1/0.25=4 times less frequent
 ### Input: string containing one word, 3 character length at least and "domination rate" optionally if we want are not interested
 # in less frequent (unpopular) words as synonyms.
+# Optional top_k sends only up to top_k synonyms, most tagged in WordNet (see get_synonyms), to N-gram API. It saves requests,
+# but may lose synonyms which would pass the threshold, so it is off by default
 # !!! Be careful. It is not recommended to set this threshold when we deal with terminology
 # !!! For example, using "test" as an input, the extended list of synonyms is:
 # !!! ['essay', 'exam', 'examination', 'examine', 'prove', 'quiz', 'run', 'screen', 'trial', 'try', 'tryout']
@@ -127,19 +330,26 @@ def get_synonym_frequency(word : str,googleAPI_key : str ="") -> float:
 # >> list of tuples where the first element is a synonym, second element is its relative frequence rounded to 5 significant digits in mantissa.
 # Please do understand that those values are somehow abstract and keeping a whole bunch of digits is meaningless
 # >> ordinary list of strings which represents the whole list of one-word synonyms sorted in lexicographic order for the sake of generality
-def get_most_frequent_synonyms(word : str,domination_rate = None|float) -> tuple[list[tuple[str,float]], list[str]]:
+def get_most_frequent_synonyms(word : str,domination_rate : float|None = None,
+                               top_k : int|None = None) -> tuple[list[tuple[str,float]], list[str]]:
     synonyms = get_synonyms(word)
     if len(synonyms)>0:
-        frequency_dict = {synonym: get_synonym_frequency(synonym) for synonym in synonyms}
-        sorted_synonyms = sorted(frequency_dict.items(), key=lambda x: x[1], reverse=True)
+        candidates = synonyms
+        if top_k is not None:
+            # fall back to the whole list when WordNet has no tagged counts for any of the synonyms
+            candidates = get_synonyms(word, top_k=top_k) or synonyms
+        words, freqs = _rank_frequencies(get_synonym_frequencies(candidates))
         # Ignore words w/o valid frequency information. Either a non-existing word or no information received
         # making N-gram request
-        base_value = sorted_synonyms[0][1]
+        base_value = freqs[0]
+        if base_value<=0:
+            return [],sorted(synonyms)
         if domination_rate is None or domination_rate<0 or domination_rate>1:
-            return [(synonym,np.round(freq/base_value,5)) for synonym, freq in sorted_synonyms if freq>0],sorted(synonyms)
+            mask = freqs>0
         else:
-            threshold = domination_rate*base_value
-            return [(synonym,np.round(freq/base_value,5)) for synonym, freq in sorted_synonyms if freq>=threshold],sorted(synonyms)
+            mask = freqs>=domination_rate*base_value
+        ratios = np.round(freqs[mask]/base_value,5)
+        return list(zip(words[mask].tolist(), ratios.tolist())),sorted(synonyms)
     else:
         return [],[]
 
@@ -150,22 +360,29 @@ def get_most_frequent_synonyms(word : str,domination_rate = None|float) -> tuple
 # this particular task is meaningless, thus ratio is rounded to two digits only
 # For example, asking about "tryout", we will get something like that: [('test', 824.62), ('trial', 141.58)]
 def get_more_frequent_synonyms(word : str) -> tuple[list[tuple[str,float]], list[str]]:
+    # the base word is requested along with the synonyms, thus it has to be normalized the same way get_synonyms() does
+    word = word.strip().lower()
     synonyms = get_synonyms(word)
     if len(synonyms)>0:
-        frequency_dict = {synonym: get_synonym_frequency(synonym) for synonym in [word]+synonyms}
+        frequency_dict = get_synonym_frequencies([word]+synonyms)
         base_value = frequency_dict[word]
-        sorted_synonyms = sorted(frequency_dict.items(), key=lambda x: x[1], reverse=True)
+        words, freqs = _rank_frequencies(frequency_dict)
         # Ignore words w/o valid frequency information. Either a non-existing word or no information received
         # making N-gram request
         # to exclude <word> from the list of results frequency has to be strictly greater then <base_value>
-        return [(synonym,np.round(freq/base_value,2)) for synonym, freq in sorted_synonyms if freq>base_value],sorted(synonyms)
+        mask = freqs>base_value
+        # unknown base word makes every found synonym infinitely more popular
+        with np.errstate(divide='ignore'):
+            ratios = np.round(freqs[mask]/base_value,2)
+        return list(zip(words[mask].tolist(), ratios.tolist())),sorted(synonyms)
     else:
         return [],[]
 
 # Example usage
-word = "tryout"
-synonyms,complete_list = get_most_frequent_synonyms(word,domination_rate=.25)
-print(f"Most frequent synonyms for '{word}' are: {synonyms}")
-print(f"Complete list of synonyms is: {complete_list}")
-synonyms_m,_ = get_more_frequent_synonyms(word)
-print(f"More frequent then '{word}' synonyms are: {synonyms_m}")
+if __name__ == "__main__":
+    word = "tryout"
+    synonyms,complete_list = get_most_frequent_synonyms(word,domination_rate=.25)
+    print(f"Most frequent synonyms for '{word}' are: {synonyms}")
+    print(f"Complete list of synonyms is: {complete_list}")
+    synonyms_m,_ = get_more_frequent_synonyms(word)
+    print(f"More frequent then '{word}' synonyms are: {synonyms_m}")